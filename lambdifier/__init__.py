@@ -1,3 +1,36 @@
-from .lines import get_def_source, get_def_ast
-from .visitor import get_local_vars, LocalVars
-from .lambdify import lambdify
+import sys
+import types
+import importlib
+
+# Names exported here and the submodules defining them. The submodules are
+# imported on first use, so that lambdifier.client stays cheap to import.
+exports = {
+    'get_def_source': 'lines',
+    'get_def_ast': 'lines',
+    'get_local_vars': 'visitor',
+    'LocalVars': 'visitor',
+    'lambdify': 'lambdify',
+    'lambdified': 'lazy',
+}
+__all__ = list(exports)
+
+
+class Package(types.ModuleType):
+    def __getattr__(self, name):
+        try:
+            module = exports[name]
+        except KeyError:
+            raise AttributeError(
+                'module %r has no attribute %r' % (__name__, name)) from None
+        value = getattr(importlib.import_module('.' + module, __name__), name)
+        types.ModuleType.__setattr__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        # Importing the lambdify submodule must not replace the function
+        if name in exports and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = Package
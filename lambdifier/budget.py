@@ -0,0 +1,43 @@
+class Metrics:
+    '''Size and shape of the text generated by a Lambdifier.'''
+
+    names = ('size', 'depth', 'folds', 'width')
+
+    def __init__(self):
+        # Characters of generated text
+        self.size = 0
+        # Deepest nesting of for and if statements
+        self.depth = 0
+        # Number of _foldl calls, one per for loop
+        self.folds = 0
+        # Most variables carried through a single for or if statement
+        self.width = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.names}
+
+    def __str__(self):
+        return ', '.join('%s=%d' % (name, getattr(self, name))
+                         for name in self.names)
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, name, limit, metrics):
+        self.name = name
+        self.limit = limit
+        self.metrics = metrics
+        super().__init__('Output %s exceeds budget of %d (%s)' %
+                         (name, limit, metrics))
+
+
+class Budget:
+    '''Upper limits on Metrics; None means unlimited.'''
+
+    def __init__(self, size=None, depth=None, folds=None, width=None):
+        self.limits = {'size': size, 'depth': depth, 'folds': folds,
+                       'width': width}
+
+    def check(self, metrics):
+        for name, limit in self.limits.items():
+            if limit is not None and getattr(metrics, name) > limit:
+                raise BudgetExceeded(name, limit, metrics)
@@ -0,0 +1,98 @@
+'''Client of the translation daemon in lambdifier.daemon.
+
+Short-lived processes import this module instead of the translator:
+it needs only os, json and socket (stat is imported by os anyway), and
+imports lambdifier.lambdify only when no server is running.
+
+Since the caller evaluates the returned text, the client only talks to
+a socket owned by the current user, in a directory no other user can
+write to: $XDG_RUNTIME_DIR, or a private directory in the temporary
+directory by default.
+'''
+import os
+import json
+import stat
+import socket
+import builtins
+
+
+def default_path():
+    try:
+        return os.environ['LAMBDIFIER_SOCKET']
+    except KeyError:
+        pass
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        # Like tempfile.gettempdir(), without importing tempfile
+        tmp = (os.environ.get('TMPDIR') or os.environ.get('TEMP') or
+               os.environ.get('TMP') or '/tmp')
+        directory = os.path.join(tmp, 'lambdifier-%d' % os.getuid())
+    return os.path.join(directory, 'lambdifier.sock')
+
+
+def check_directory(directory):
+    # Only the current user (or root) may create or replace files in it
+    st = os.stat(directory)
+    if st.st_uid not in (os.getuid(), 0) or (
+            st.st_mode & 0o022 and not st.st_mode & stat.S_ISVTX):
+        raise PermissionError(
+            '%s is writable by other users' % directory)
+
+
+def check_socket(path):
+    check_directory(os.path.dirname(os.path.abspath(path)))
+    st = os.lstat(path)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(
+            '%s is not a socket of the current user' % path)
+
+
+class Client:
+    def __init__(self, path=None):
+        path = path or default_path()
+        check_socket(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rwb')
+
+    def lambdify(self, source, batch=False):
+        request = {'source': source, 'batch': batch}
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('lambdifier daemon closed the connection')
+        response = json.loads(line.decode())
+        if 'error' in response:
+            exc = getattr(builtins, response['error'], None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                exc = RuntimeError
+            raise exc(response['message'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def lambdify(node, batch=False, path=None):
+    '''Lambdify through the daemon if one is running, else in-process.'''
+    if hasattr(node, '__code__'):
+        from lambdifier.lines import get_def_source
+        node = get_def_source(node)
+    if isinstance(node, str):
+        try:
+            client = Client(path)
+        except OSError:
+            pass
+        else:
+            try:
+                return client.lambdify(node, batch)
+            finally:
+                client.close()
+    from lambdifier.lambdify import lambdify as lambdify_local
+    return lambdify_local(node, batch=batch)
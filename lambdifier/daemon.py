@@ -0,0 +1,173 @@
+'''Local translation server with a warm cache.
+
+Usage: python -m lambdifier.daemon serve [--socket PATH]
+       python -m lambdifier.daemon bench [-n COUNT] [--processes COUNT]
+
+The server listens on a Unix socket and answers one JSON object per line:
+requests carry the source of a function definition, responses carry the
+lambdified text or the name and message of the exception raised by the
+translation. Results are cached by source hash.
+lambdify() in lambdifier.client asks the server and falls back to
+translating in-process when no server is running.
+'''
+import os
+import sys
+import json
+import time
+import subprocess
+import argparse
+import tempfile
+import threading
+import socketserver
+from lambdifier.lines import source_hash
+from lambdifier.lambdify import Lambdifier, lambdify as lambdify_local
+from lambdifier.client import (
+    default_path, check_directory, Client, lambdify)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line.decode())
+            response = self.server.translate(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, 0o700, exist_ok=True)
+        check_directory(directory)
+        if os.path.exists(self.path):
+            try:
+                Client(self.path).close()
+            except OSError:
+                # Stale socket of a server that did not shut down cleanly
+                os.unlink(self.path)
+            else:
+                raise OSError('A server is already listening on %s' %
+                              self.path)
+        super().__init__(self.path, Handler)
+        # (source hash, batch) -> response
+        self.cache = {}
+        self.hits = 0
+
+    def translate(self, request):
+        key = (source_hash(request['source']), request.get('batch', False))
+        try:
+            response = self.cache[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return response
+        try:
+            result = Lambdifier(batch=key[1])(request['source'])
+        except Exception as e:
+            response = {'error': type(e).__name__, 'message': str(e)}
+        else:
+            response = {'result': result}
+        self.cache[key] = response
+        return response
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+BENCH_SOURCE = '''\
+def kmeans(x, K):
+    n, x = len(x), [None]+list(x)
+    dp = [[None]*(K+1) for _ in range(n+1)]
+    for i in range(1, n+1):
+        for k in range(1, K+1):
+            if k >= i:
+                dp[i][k] = 0
+            else:
+                for j in range(1, i):
+                    v = dp[j][k-1]
+                    for h in range(j+1, i+1):
+                        v = v + x[h]
+                    if j == 1 or v < dp[i][k]:
+                        dp[i][k] = v
+    return dp
+'''
+
+
+def run_process(code, path):
+    # Wall time of a new interpreter running code
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = os.environ.get('PYTHONPATH')
+    env = dict(os.environ, LAMBDIFIER_SOCKET=path,
+               PYTHONPATH=root + os.pathsep + pythonpath
+               if pythonpath else root)
+    t = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
+    return time.perf_counter() - t
+
+
+def bench(count=100, processes=10):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.sock')
+    server = Server(path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    code = 'from lambdifier.%s import lambdify; lambdify(%r)'
+    try:
+        t = time.perf_counter()
+        for _ in range(count):
+            lambdify_local(BENCH_SOURCE)
+        local = (time.perf_counter() - t) / count
+        # The first request fills the server's cache
+        lambdify(BENCH_SOURCE, path=path)
+        t = time.perf_counter()
+        for _ in range(count):
+            lambdify(BENCH_SOURCE, path=path)
+        warm = (time.perf_counter() - t) / count
+        # Startup, import and translation of a short-lived process
+        bare = sum(run_process('pass', path)
+                   for _ in range(processes)) / processes
+        cold = sum(run_process(code % ('lambdify', BENCH_SOURCE), path)
+                   for _ in range(processes)) / processes
+        client = sum(run_process(code % ('client', BENCH_SOURCE), path)
+                     for _ in range(processes)) / processes
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.rmdir(directory)
+    print('in-process translation:        %8.3f ms' % (local * 1e3))
+    print('warm daemon request:           %8.3f ms' % (warm * 1e3))
+    print('new process, no imports:       %8.3f ms' % (bare * 1e3))
+    print('new process, translating:      %8.3f ms' % (cold * 1e3))
+    print('new process, asking daemon:    %8.3f ms' % (client * 1e3))
+    return local, warm, bare, cold, client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--socket', default=None)
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=10)
+    args = parser.parse_args()
+    if args.command == 'bench':
+        bench(args.count, args.processes)
+        return
+    server = Server(args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+'''Differential testing of lambdified functions against the originals.
+
+Random functions are generated within the supported subset (assignment
+to locals, subscripts and attributes, for, if and a trailing return),
+lambdified, and run side by side on random inputs. A function is flagged
+if the results or side effects differ, or if the lambdified version is
+more than max_ratio times slower than the original.
+
+Known failures can be recorded with --save-baseline in a baseline file,
+a JSON object mapping the source hash of each failing or slow function
+to its exception, or the input and results it fails on. With --baseline,
+only new or changed failures and newly slow functions are flagged.
+
+Usage: python -m lambdifier.fuzz [-n COUNT] [--seed SEED] [--max-ratio R]
+                                 [--baseline FILE] [--save-baseline FILE]
+'''
+import copy
+import json
+import time
+import random
+import argparse
+import types
+from lambdifier.lambdify import lambdify
+from lambdifier.lines import source_hash
+
+
+PARAMS = ('a', 'b', 'xs', 'o')
+LOCALS = ('x', 'y', 'z')
+ATTRS = ('p', 'q')
+
+
+class FunctionGenerator:
+    def __init__(self, rng, max_depth=2, max_statements=4):
+        self.rng = rng
+        self.max_depth = max_depth
+        self.max_statements = max_statements
+
+    def function(self, name='f'):
+        lines = ['def %s(%s):' % (name, ', '.join(PARAMS))]
+        # Bind every local up front, since branches of an if statement
+        # may read locals that only the other branch assigns.
+        lines.extend('    %s = %s' % (v, self.rng.randrange(10))
+                     for v in LOCALS)
+        lines.extend(self.block(1, ()))
+        lines.append('    return (%s)' % ', '.join(LOCALS))
+        return '\n'.join(lines) + '\n'
+
+    def block(self, depth, loop_vars):
+        n = self.rng.randint(1, self.max_statements)
+        for _ in range(n):
+            yield from self.statement(depth, loop_vars)
+
+    def statement(self, depth, loop_vars):
+        indent = '    ' * depth
+        kinds = ['assign', 'assign', 'subscript', 'attribute']
+        if depth <= self.max_depth:
+            kinds += ['for', 'if']
+        kind = self.rng.choice(kinds)
+        if kind == 'assign':
+            yield '%s%s = %s' % (indent, self.rng.choice(LOCALS),
+                                 self.expr(loop_vars))
+        elif kind == 'subscript':
+            yield '%sxs[(%s) %% len(xs)] = %s' % (
+                indent, self.expr(loop_vars, 1), self.expr(loop_vars))
+        elif kind == 'attribute':
+            yield '%so.%s = %s' % (indent, self.rng.choice(ATTRS),
+                                   self.expr(loop_vars))
+        elif kind == 'for':
+            # Loop variables are only read inside their own loop
+            var = 'i%d' % depth
+            yield '%sfor %s in range(%s):' % (
+                indent, var, self.rng.choice(['len(xs)', '3', 'a % 5']))
+            yield from self.block(depth + 1, loop_vars + (var,))
+        else:
+            yield '%sif %s:' % (indent, self.condition(loop_vars))
+            yield from self.block(depth + 1, loop_vars)
+            if self.rng.random() < 0.5:
+                yield '%selse:' % indent
+                yield from self.block(depth + 1, loop_vars)
+
+    def expr(self, loop_vars, depth=2):
+        kinds = ['const', 'name', 'name']
+        if depth > 0:
+            kinds += ['binop', 'binop', 'subscript', 'attribute']
+        kind = self.rng.choice(kinds)
+        if kind == 'const':
+            return str(self.rng.randrange(-5, 10))
+        elif kind == 'name':
+            return self.rng.choice(('a', 'b') + LOCALS + loop_vars)
+        elif kind == 'subscript':
+            return 'xs[(%s) %% len(xs)]' % self.expr(loop_vars, depth - 1)
+        elif kind == 'attribute':
+            return 'o.%s' % self.rng.choice(ATTRS)
+        # Keep values small so long loops do not build huge integers
+        op = self.rng.choice(['+', '-', '*', '%'])
+        left = self.expr(loop_vars, depth - 1)
+        right = self.expr(loop_vars, depth - 1)
+        if op == '%':
+            return '(%s) %% 97' % left
+        if op == '*':
+            return '((%s) * (%s)) %% 97' % (left, right)
+        return '(%s) %s (%s)' % (left, op, right)
+
+    def condition(self, loop_vars):
+        op = self.rng.choice(['<', '>', '==', '!=', '<=', '>='])
+        return '%s %s %s' % (self.expr(loop_vars, 1), op,
+                             self.expr(loop_vars, 1))
+
+    def arguments(self):
+        xs = [self.rng.randrange(-10, 10)
+              for _ in range(self.rng.randint(1, 5))]
+        o = types.SimpleNamespace(**{k: self.rng.randrange(10)
+                                     for k in ATTRS})
+        return (self.rng.randrange(-10, 10), self.rng.randrange(-10, 10),
+                xs, o)
+
+
+def run(fn, args):
+    # Return value and final state of the mutable arguments
+    args = copy.deepcopy(args)
+    try:
+        result = fn(*args)
+    except Exception as e:
+        result = type(e)
+    _, _, xs, o = args
+    return result, xs, vars(o)
+
+
+def timing(fn, args, number):
+    args = [copy.deepcopy(args) for _ in range(number)]
+    t = time.perf_counter()
+    for a in args:
+        try:
+            fn(*a)
+        except Exception:
+            pass
+    return time.perf_counter() - t
+
+
+class Result:
+    def __init__(self, source, lambda_source=None, error=None,
+                 mismatch=None, ratio=None):
+        self.source = source
+        self.lambda_source = lambda_source
+        # Exception raised while lambdifying
+        self.error = error
+        # (args, expected, actual) of the first differing input
+        self.mismatch = mismatch
+        # Runtime of the lambda relative to the original
+        self.ratio = ratio
+        self.hash = source_hash(source)
+        # "seed:index" of the generated function, set by results()
+        self.name = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.mismatch is None
+
+    def failure(self):
+        # Detailed enough to tell a changed failure from a known one
+        if self.error is not None:
+            return 'error: %s: %s' % (type(self.error).__name__, self.error)
+        if self.mismatch is not None:
+            return 'mismatch on %r: %r != %r' % self.mismatch
+        return None
+
+    def slow(self, max_ratio):
+        return (max_ratio is not None and self.ratio is not None and
+                self.ratio > max_ratio)
+
+    def __str__(self):
+        if self.error is not None:
+            return 'error: %r\n%s' % (self.error, self.source)
+        if self.mismatch is not None:
+            args, expected, actual = self.mismatch
+            return 'mismatch on %r: %r != %r\n%s\n%s' % (
+                args, expected, actual, self.source, self.lambda_source)
+        return 'ok, %.1fx slower\n%s' % (self.ratio, self.source)
+
+
+def check(source, args_list, number=20, translate=lambdify):
+    namespace = {}
+    exec(source, namespace)
+    fn = namespace['f']
+    try:
+        lambda_source = translate(source)
+        lam = eval(lambda_source)
+    except Exception as e:
+        return Result(source, error=e)
+    mismatch = None
+    for args in args_list:
+        expected = run(fn, args)
+        actual = run(lam, args)
+        if expected != actual:
+            mismatch = (args, expected, actual)
+            break
+    # Time mismatching functions too, so they are still checked for speed
+    t_fn = sum(timing(fn, args, number) for args in args_list)
+    t_lam = sum(timing(lam, args, number) for args in args_list)
+    return Result(source, lambda_source, mismatch=mismatch,
+                  ratio=t_lam / max(t_fn, 1e-9))
+
+
+def results(count=100, seed=0, inputs=5, number=20, translate=lambdify):
+    '''Check `count` random functions; yield a Result for each.'''
+    rng = random.Random(seed)
+    gen = FunctionGenerator(rng)
+    for i in range(count):
+        source = gen.function()
+        args_list = [gen.arguments() for _ in range(inputs)]
+        result = check(source, args_list, number, translate)
+        result.name = '%d:%d' % (seed, i)
+        yield result
+
+
+def fuzz(count=100, seed=0, inputs=5, number=20, max_ratio=None,
+         baseline=None, translate=lambdify):
+    '''Check `count` random functions; yield the Results to be flagged.
+
+    With a baseline dict, as written by save_baseline(), only failures
+    that differ from the recorded one and functions that were not slow
+    before are flagged.
+    '''
+    for result in results(count, seed, inputs, number, translate):
+        known = (baseline or {}).get(result.hash, {})
+        failure = result.failure()
+        if (failure is not None and failure != known.get('failure') or
+                result.slow(max_ratio) and not known.get('slow')):
+            yield result
+
+
+def load_baseline(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def save_baseline(filename, results, max_ratio=None):
+    baseline = {}
+    for result in results:
+        failure = result.failure()
+        slow = result.slow(max_ratio)
+        if failure is not None or slow:
+            baseline[result.hash] = {'name': result.name, 'failure': failure,
+                                     'slow': slow}
+    with open(filename, 'w') as fp:
+        json.dump(baseline, fp, indent=1, sort_keys=True)
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-ratio', type=float, default=None)
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='only flag new failures and slowdowns')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='record every failing or slow function')
+    args = parser.parse_args()
+    if args.save_baseline:
+        baseline = save_baseline(args.save_baseline,
+                                 results(args.count, args.seed),
+                                 args.max_ratio)
+        print('%d of %d functions recorded in %s' %
+              (len(baseline), args.count, args.save_baseline))
+        return
+    baseline = None
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+    flagged = 0
+    for result in fuzz(args.count, args.seed, max_ratio=args.max_ratio,
+                       baseline=baseline):
+        flagged += 1
+        print('%s %s' % (result.name, result))
+        print()
+    print('%d of %d functions flagged' % (flagged, args.count))
+    if flagged:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
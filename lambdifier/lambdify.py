@@ -1,9 +1,18 @@
 import re
 import ast
+import logging
 import itertools
+import contextlib
 from lambdifier.visitor import (
     LocalVars, ReadVars, as_ast, find_loops, ReadBeforeWrite)
+from lambdifier.lines import get_def_lineno
 from lambdifier.precedence import AutoParens
+from lambdifier.budget import Metrics
+from lambdifier.profiling import TranslationProfile
+from lambdifier.sourcemap import SourceMap
+
+
+logger = logging.getLogger(__name__)
 
 
 # foldl(f, a, it) -> f(*f(...*f(*a, next(it))..., next(it)), next(it))
@@ -31,44 +40,207 @@ foldwhile = (
     'g(g, f, a, c))')
 
 
+# loopcount(key, it) yields from `it`, counting iterations and time
+# in lambdifier.loopstats.registry[key]
+loopcount = "__import__('lambdifier.loopstats', fromlist=['count']).count"
+
+
+# From fstrings
+BINOPS = {
+    ast.Add: ' + ',
+    ast.Sub: ' - ',
+    ast.Mult: ' * ',
+    ast.MatMult: ' @ ',
+    ast.Div: ' / ',
+    ast.FloorDiv: ' // ',
+    ast.Mod: ' % ',
+    ast.Pow: ' ** ',
+    ast.LShift: ' << ',
+    ast.RShift: ' >> ',
+    ast.BitOr: ' | ',
+    ast.BitXor: ' ^ ',
+    ast.BitAnd: ' & ',
+}
+
+BOOLOPS = {
+    ast.And: ' and ',
+    ast.Or: ' or ',
+}
+
+CMPOPS = {
+    ast.Lt: ' < ',
+    ast.Gt: ' > ',
+    ast.LtE: ' <= ',
+    ast.GtE: ' >= ',
+    ast.Eq: ' == ',
+    ast.NotEq: ' != ',
+    ast.In: ' in ',
+    ast.NotIn: ' not in ',
+    ast.Is: ' is ',
+    ast.IsNot: ' is not ',
+}
+
+UNARYOPS = {
+    ast.Not: 'not ',
+    ast.UAdd: '+',
+    ast.USub: '-',
+    ast.Invert: '~',
+}
+
+
 class Visitor:
     def visit(self, node):
         if isinstance(node, list):
             yield from itertools.chain.from_iterable(map(self.visit, node))
         else:
             method_name = 'visit_' + node.__class__.__name__
-            method = getattr(self, method_name)
+            method = getattr(self, method_name, None)
+            if method is None:
+                raise NotImplementedError(node.__class__.__name__)
             try:
                 yield from method(node)
             except Exception:
-                print('In', method_name)
+                logger.debug('In %s', method_name)
                 raise
 
 
 class Lambdifier(Visitor):
+    # Prefixes of the methods timed when profiling
+    instrumented = ('visit_', 'target_', 'store_')
+
+    def __init__(self, profile=None, source_map=False, count_loops=False,
+                 budget=None, batch=False):
+        # profile may be True, or a callable taking a TranslationProfile
+        self.on_profile = profile
+        self.profile = None
+        self.on_source_map = source_map
+        self.source_map = None
+        # Wrap loop iterables in lambdifier.loopstats.count
+        self.count_loops = count_loops
+        # Budget to check the Metrics against while emitting
+        self.budget = budget
+        self.metrics = None
+        # Emit a lambda taking an iterable of argument tuples
+        self.batch = batch
+
     def __call__(self, node):
+        if not (self.on_profile or self.on_source_map):
+            return self.translate(node)
+        if self.on_profile:
+            self.profile = TranslationProfile()
+            self.instrument(self.profile)
+        if self.on_source_map:
+            self.location = []
+            self.visit = self.mapped_visit
+        try:
+            return self.translate(node)
+        finally:
+            self.uninstrument()
+            if self.profile is not None and callable(self.on_profile):
+                self.on_profile(self.profile)
+
+    def instrument(self, profile):
+        for name in dir(type(self)):
+            if name.startswith(self.instrumented):
+                setattr(self, name, profile.wrap(name, getattr(self, name)))
+
+    def uninstrument(self):
+        for name in list(vars(self)):
+            if name == 'visit' or name.startswith(self.instrumented):
+                delattr(self, name)
+
+    def mapped_visit(self, node):
+        if not hasattr(node, 'lineno'):
+            return Visitor.visit(self, node)
+        return self.located_visit(node)
+
+    def located_visit(self, node):
+        self.location.append(node)
+        yield from Visitor.visit(self, node)
+        self.location.pop()
+
+    def phase(self, name):
+        if self.profile is None:
+            return contextlib.suppress()
+        return self.profile.phase(name)
+
+    def translate(self, node):
         self.auto_parens = AutoParens()
         self.copy_vars = ReadBeforeWrite()
 
-        node = as_ast(node)
+        if hasattr(node, '__code__'):
+            self.name = node.__qualname__
+            self.filename = node.__code__.co_filename
+            self.first_lineno = get_def_lineno(node)
+        else:
+            self.name = self.filename = None
+            self.first_lineno = 1
+        with self.phase('source'):
+            node = as_ast(node)
+        if self.on_source_map:
+            self.source_map = SourceMap(self.name or node.name,
+                                        self.filename, self.first_lineno)
         self.node = node
-        self.copy_vars(node)
+        # A return before the last statement would not end the function
+        for child in ast.walk(node):
+            if isinstance(child, ast.Return) and child is not node.body[-1]:
+                raise NotImplementedError('return not at end of function')
         lv = LocalVars()
         rv = ReadVars()
-        write = lv(self.node)
-        read = ' '.join(rv(self.node))
+        with self.phase('ReadBeforeWrite'):
+            self.copy_vars(node)
+        with self.phase('LocalVars'):
+            write = lv(self.node)
+        with self.phase('ReadVars'):
+            read = ' '.join(rv(self.node))
         self.scopes = lv.scopes
         self.return_var = '_result'
         self.target_var = '_t'
         self.unused_var = '_'
+        self.batch_var = '_batch'
         # User code may not write to our result variable
         assert self.return_var not in set(write)
+        assert not self.batch or self.batch_var not in read.split()
         # User code may not read our temporaries
         temp_pattern = r'\b_(t\d*)?\b'
         assert not re.search(temp_pattern, read)
-        return ''.join(self.toplevel(node))
+        self.metrics = Metrics()
+        self.depth = 0
+        with self.phase('emit'):
+            chunks = self.toplevel(node)
+            if self.budget is not None:
+                chunks = self.budgeted(chunks)
+            if self.source_map is None:
+                source = ''.join(chunks)
+            else:
+                self.location.append(node)
+                source = self.source_map.record(chunks, self.location)
+        self.metrics.size = len(source)
+        if self.profile is not None:
+            self.profile.count_nodes(node)
+            self.profile.output_size = len(source)
+        return source
+
+    def budgeted(self, chunks):
+        # Fail as soon as the output exceeds the budget
+        for chunk in chunks:
+            self.metrics.size += len(chunk)
+            self.budget.check(self.metrics)
+            yield chunk
+
+    def enter_block(self, width):
+        self.depth += 1
+        self.metrics.depth = max(self.metrics.depth, self.depth)
+        self.metrics.width = max(self.metrics.width, width)
+
+    def location_key(self, node):
+        return (self.filename or '<string>',
+                node.lineno + self.first_lineno - 1, node.col_offset)
 
     def toplevel(self, node):
+        if self.batch:
+            yield from self.toplevel_batch(node)
+            return
         yield 'lambda'
         yield from self.visit(node.args)
         yield ': [{r}'.format(r=self.return_var)
@@ -79,13 +251,42 @@ class Lambdifier(Visitor):
                 par += ','
             yield '\nfor ({par}) in [({par})]'.format(par=par)
         yield '\nfor {r} in [None]'.format(r=self.return_var)
+        yield from self.helpers(node)
+        yield from self.visit(node.body)
+        yield '][0]'
+
+    def toplevel_batch(self, node):
+        # lambda _batch: generator of f(*args) for args in _batch,
+        # constructing the helpers only once.
+        args = node.args
+        if args.vararg or args.kwonlyargs or args.kwarg:
+            raise NotImplementedError(
+                'batch with *args, keyword-only arguments or **kwargs')
+        if args.defaults:
+            # Each tuple is unpacked into exactly the parameters
+            raise NotImplementedError('batch with default arguments')
+        yield 'lambda {b}: ({r}'.format(b=self.batch_var, r=self.return_var)
+        yield from self.helpers(node)
+        par = ', '.join(self.arg_names(args))
+        if not par:
+            yield '\nfor {u} in {b}'.format(u=self.unused_var,
+                                            b=self.batch_var)
+        else:
+            if ', ' not in par:
+                par += ','
+            yield '\nfor ({par}) in {b}'.format(par=par, b=self.batch_var)
+        yield '\nfor {r} in [None]'.format(r=self.return_var)
+        yield from self.visit(node.body)
+        yield ')'
+
+    def helpers(self, node):
         loops = find_loops(node)
         if 'for' in loops:
             yield '\nfor _foldl in [%s]' % foldl
         if 'while' in loops:
             yield '\nfor _foldwhile in [%s]' % foldwhile
-        yield from self.visit(node.body)
-        yield '][0]'
+        if loops and self.count_loops:
+            yield '\nfor _loopcount in [%s]' % loopcount
 
     def visit_Return(self, node):
         yield '\nfor %s in [' % self.return_var
@@ -105,7 +306,32 @@ class Lambdifier(Visitor):
             return
         yield from self.primitive_assign(self.unused_var, expr.value)
 
+    def is_plain(self, node):
+        # A name or constant
+        if isinstance(node, ast.Index):
+            node = node.value
+        return isinstance(node, (ast.Name, ast.Num, ast.Str,
+                                 ast.NameConstant))
+
+    def store_in_order(self, target, expr):
+        # Storing directly evaluates the target before the value, unlike
+        # Python; only do so when neither can affect the other.
+        parts = [target.value]
+        if isinstance(target, ast.Subscript):
+            parts.append(target.slice)
+        if all(map(self.is_plain, parts)):
+            return True
+        return not any(isinstance(n, ast.Call)
+                       for n in itertools.chain.from_iterable(
+                           map(ast.walk, parts + [expr])))
+
     def assign_single(self, target, expr):
+        # A lone subscript or attribute target is stored directly if
+        # possible; otherwise the value goes through a temporary first.
+        store = getattr(self, 'store_' + target.__class__.__name__, None)
+        if store is not None and self.store_in_order(target, expr):
+            yield from store(target, expr)
+            return
         self.assign_temp = []
         yield '\nfor '
         method = getattr(self, 'target_' + target.__class__.__name__)
@@ -120,6 +346,22 @@ class Lambdifier(Visitor):
     def target_Name(self, target):
         yield target.id
 
+    def store_Attribute(self, target, expr):
+        yield '\nfor %s in [setattr(' % self.unused_var
+        yield from self.visit(target.value)
+        yield ', %r, ' % (target.attr,)
+        yield from self.visit(expr)
+        yield ')]'
+
+    def store_Subscript(self, target, expr):
+        yield '\nfor %s in [(' % self.unused_var
+        yield from self.visit(target.value)
+        yield ').__setitem__('
+        yield from self.visit(target.slice)
+        yield ', '
+        yield from self.visit(expr)
+        yield ')]'
+
     def target_Attribute(self, target):
         n = len(self.assign_temp)
         tmp = '_t%s' % n
@@ -203,22 +445,13 @@ class Lambdifier(Visitor):
             sep = ', '
 
     def visit_AugAssign(self, node):
-        # From fstrings
-        ops = {
-            ast.Mod: '%',
-            ast.Sub: '-',
-            ast.Add: '+',
-            ast.Mult: '*',
-            ast.Pow: '**',
-            ast.Div: '/',
-            ast.FloorDiv: '//',
-        }
         # Rewrite into Assign and BinOp,
         # even though this is not always valid
         return self.visit(ast.Assign(
             [node.target], ast.BinOp(node.target, node.op, node.value)))
 
     def visit_If(self, node):
+        self.enter_block(len(self.scopes[id(node)]))
         locs = ', '.join(self.scopes[id(node)])
         result_vars = ('(%s)' % locs) if locs else self.unused_var
         result_vals = ('(%s)' % locs) if locs else '0'
@@ -238,6 +471,7 @@ class Lambdifier(Visitor):
             yield '\nfor (%s) in [(%s)]' % (v, v)
         yield from self.visit(node.orelse)
         yield '])'
+        self.depth -= 1
 
     def visit_For(self, node):
         self.assign_temp = []
@@ -253,6 +487,8 @@ class Lambdifier(Visitor):
         except KeyError:
             print("No locals in for loop?")
             raise
+        self.enter_block(len(var_list))
+        self.metrics.folds += 1
         copy = self.copy_vars.copy(node)
         result_vars = ', '.join(var_list)
         init_vars = ', '.join(v if v in copy else 'None' for v in var_list)
@@ -273,7 +509,13 @@ class Lambdifier(Visitor):
             yield '\nfor (%s) in [(%s)]' % (v, v)
         yield from self.visit(node.body)
         yield '][0],\n%s, ' % init
-        yield from self.visit(node.iter)
+        self.depth -= 1
+        if self.count_loops:
+            yield '_loopcount(%r, ' % (self.location_key(node),)
+            yield from self.visit(node.iter)
+            yield ')'
+        else:
+            yield from self.visit(node.iter)
         yield ')]'
 
     def visit_While(self, node):
@@ -290,7 +532,11 @@ class Lambdifier(Visitor):
 
     def visit_Call(self, node):
         # From fstrings
+        l, r = self.auto_parens.open(node)
+        yield l
+        self.auto_parens.operand('left')
         yield from self.visit(node.func)
+        self.auto_parens.bracket()
         yield '('
         yield from self.commasep_visit(node.args)
         for j, kw in enumerate(node.keywords):
@@ -304,6 +550,9 @@ class Lambdifier(Visitor):
                 yield k + '='
             yield from self.visit(v)
         yield ')'
+        self.auto_parens.close('')
+        yield r
+        self.auto_parens.close(r)
 
     def visit_Name(self, node):
         yield node.id
@@ -320,6 +569,7 @@ class Lambdifier(Visitor):
     def visit_Tuple(self, node):
         # From fstrings
         if len(node.elts) > 0:
+            self.auto_parens.bracket()
             yield '('
             yield from self.visit(node.elts[0])
             for e in node.elts[1:]:
@@ -328,20 +578,25 @@ class Lambdifier(Visitor):
             if len(node.elts) == 1:
                 yield ','
             yield ')'
+            self.auto_parens.close('')
         else:
             yield '()'
 
     def visit_List(self, node):
         # From fstrings
+        self.auto_parens.bracket()
         yield '['
         yield from self.commasep_visit(node.elts)
         yield ']'
+        self.auto_parens.close('')
 
     def visit_ListComp(self, node):
+        self.auto_parens.bracket()
         yield '['
         yield from self.visit(node.elt)
         yield from self.visit(node.generators)
         yield ']'
+        self.auto_parens.close('')
 
     def visit_comprehension(self, node):
         yield ' async for ' if node.is_async else ' for '
@@ -354,6 +609,7 @@ class Lambdifier(Visitor):
 
     def visit_Dict(self, node):
         # From fstrings
+        self.auto_parens.bracket()
         yield '{'
         for k, v in zip(node.keys, node.values):
             yield from self.visit(k)
@@ -361,65 +617,82 @@ class Lambdifier(Visitor):
             yield from self.visit(v)
             yield ','
         yield '}'
+        self.auto_parens.close('')
 
     def visit_BinOp(self, node):
-        # From fstrings
-        ops = {
-            ast.Mod: '%',
-            ast.Sub: '-',
-            ast.Add: '+',
-            ast.Mult: '*',
-            ast.Pow: '**',
-            ast.Div: '/',
-            ast.FloorDiv: '//',
-        }
-        with self.auto_parens(node, node.op, node.left, node.right) as (l, r):
-            yield l
-            yield from self.visit(node.left)
-            yield ' %s ' % (ops.get(type(node.op), str(node.op)),)
-            yield from self.visit(node.right)
-            yield r
+        l, r = self.auto_parens.open(node.op)
+        yield l
+        self.auto_parens.operand('left')
+        yield from self.visit(node.left)
+        yield BINOPS[type(node.op)]
+        self.auto_parens.operand('right')
+        yield from self.visit(node.right)
+        yield r
+        self.auto_parens.close(r)
 
     def visit_BoolOp(self, node):
-        ops = {
-            ast.And: ' and ',
-            ast.Or: ' or ',
-        }
-        with self.auto_parens(node, node.op, node.values[0], node.values[-1]) as (l, r):
-            yield l
-            for i, v in enumerate(node.values):
-                if i:
-                    yield ops[type(node.op)]
-                yield from self.visit(v)
-            yield r
+        l, r = self.auto_parens.open(node.op)
+        yield l
+        op = BOOLOPS[type(node.op)]
+        for i, v in enumerate(node.values):
+            if i:
+                yield op
+            self.auto_parens.operand('right' if i else 'left')
+            yield from self.visit(v)
+        yield r
+        self.auto_parens.close(r)
+
+    def visit_UnaryOp(self, node):
+        l, r = self.auto_parens.open(node.op)
+        yield l
+        yield UNARYOPS[type(node.op)]
+        self.auto_parens.operand(None)
+        yield from self.visit(node.operand)
+        yield r
+        self.auto_parens.close(r)
 
     def visit_Compare(self, node):
-        # From fstrings
+        # All comparison operators share one precedence level
+        l, r = self.auto_parens.open(node.ops[0])
+        yield l
+        self.auto_parens.operand('left')
         yield from self.visit(node.left)
-        ops = {
-            ast.Lt: '<',
-            ast.Gt: '>',
-            ast.LtE: '<=',
-            ast.GtE: '>=',
-            ast.Eq: '==',
-            ast.NotEq: '!=',
-            ast.In: ' in ',
-            ast.Is: ' is ',
-            ast.IsNot: ' is not ',
-        }
+        self.auto_parens.operand('right')
         for op, right in zip(node.ops, node.comparators):
-            yield ' %s ' % (ops.get(type(op), '?'),)
+            yield CMPOPS[type(op)]
             yield from self.visit(right)
+        yield r
+        self.auto_parens.close(r)
+
+    def visit_Attribute(self, node):
+        l, r = self.auto_parens.open(node)
+        yield l
+        self.auto_parens.operand('left')
+        yield from self.visit(node.value)
+        yield '.' + node.attr
+        yield r
+        self.auto_parens.close(r)
 
     def visit_Subscript(self, node):
+        l, r = self.auto_parens.open(node)
+        yield l
+        self.auto_parens.operand('left')
         yield from self.visit(node.value)
+        self.auto_parens.bracket()
         yield '['
         yield from self.visit(node.slice)
         yield ']'
+        self.auto_parens.close('')
+        yield r
+        self.auto_parens.close(r)
 
     def visit_Index(self, node):
         yield from self.visit(node.value)
 
 
-def lambdify(node):
-    return Lambdifier()(node)
+def lambdify(node, profile=None, budget=None, batch=False):
+    if profile and not callable(profile):
+        # The profile would be lost along with the Lambdifier
+        raise TypeError('lambdify() needs a callable profile; '
+                        'use Lambdifier(profile=True).profile instead')
+    return Lambdifier(profile, budget=budget, batch=batch)(node)
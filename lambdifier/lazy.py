@@ -0,0 +1,109 @@
+import types
+import pickle
+import logging
+import functools
+import importlib
+from lambdifier.lines import get_def_source, source_hash
+from lambdifier.lambdify import Lambdifier
+
+
+logger = logging.getLogger(__name__)
+
+# (module, qualname, source hash) -> LambdifiedFunction, consulted when
+# unpickling; functions with the same source in different places differ
+cache = {}
+
+
+def translate(fn, batch=False):
+    # Return the lambdified form of fn, or None if it cannot be lambdified.
+    if fn.__code__.co_freevars:
+        # The lambda is evaluated in fn's globals and cannot see closures
+        logger.info('Not lambdifying %s: closure over %s', fn.__qualname__,
+                    ', '.join(fn.__code__.co_freevars))
+        return None
+    try:
+        source = Lambdifier(batch=batch)(fn)
+        code = compile(source, '<lambdified %s>' % fn.__qualname__, 'eval')
+        return eval(code, fn.__globals__)
+    except Exception as e:
+        # Syntax outside the supported subset fails in various ways, and
+        # deeply nested output may exceed the parser's limits
+        logger.info('Not lambdifying %s: %s: %s', fn.__qualname__,
+                    type(e).__name__, e)
+        return None
+
+
+class LambdifiedFunction:
+    '''A function replaced by its lambdified form on the first call.
+
+    Instances pickle by reference to the module, qualified name and source
+    hash of the original function, so a worker process looks them up in
+    `cache` and translates each function at most once.
+    '''
+
+    def __init__(self, fn):
+        functools.update_wrapper(self, fn)
+        self.impl = None
+        self.batch_impl = None
+        self.source_hash = None
+
+    def __call__(self, *args, **kwargs):
+        impl = self.impl
+        if impl is None:
+            impl = self.impl = translate(self.__wrapped__) or self.__wrapped__
+        return impl(*args, **kwargs)
+
+    def batch(self, args):
+        '''Return a generator of self(*a) for each tuple a in args.'''
+        impl = self.batch_impl
+        if impl is None:
+            impl = translate(self.__wrapped__, batch=True)
+            if impl is None:
+                fn = self.__wrapped__
+                impl = lambda args: (fn(*a) for a in args)
+            self.batch_impl = impl
+        return impl(args)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+    def get_source_hash(self):
+        if self.source_hash is None:
+            self.source_hash = source_hash(get_def_source(self.__wrapped__))
+            cache[self.__module__, self.__qualname__, self.source_hash] = self
+        return self.source_hash
+
+    def __reduce__(self):
+        if '<locals>' in self.__qualname__:
+            raise pickle.PicklingError(
+                "Can't pickle local function %s" % self.__qualname__)
+        return (rebuild,
+                (self.__module__, self.__qualname__, self.get_source_hash()))
+
+    def __repr__(self):
+        return '<lambdified %s>' % self.__qualname__
+
+
+def rebuild(module, qualname, hash):
+    try:
+        return cache[module, qualname, hash]
+    except KeyError:
+        pass
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    if not isinstance(obj, LambdifiedFunction):
+        raise pickle.UnpicklingError(
+            '%s.%s is not lambdified' % (module, qualname))
+    if obj.get_source_hash() != hash:
+        raise pickle.UnpicklingError(
+            '%s.%s changed since it was pickled' % (module, qualname))
+    cache[module, qualname, hash] = obj
+    return obj
+
+
+def lambdified(fn):
+    '''Replace fn by its lambdified form, translated on the first call.'''
+    return LambdifiedFunction(fn)
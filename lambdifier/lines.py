@@ -1,4 +1,5 @@
 import ast
+import hashlib
 import itertools
 
 
@@ -13,6 +14,16 @@ def lines_from(filename, line):
 lines_from.cache = {}
 
 
+def invalidate(filename=None):
+    # Forget cached lines of filename, or of all files
+    if filename is None:
+        lines_from.cache.clear()
+        parse_file.cache.clear()
+    else:
+        lines_from.cache.pop(filename, None)
+        parse_file.cache.pop(filename, None)
+
+
 def iter_dedent(lines):
     first_line = next(lines)
     indent = len(first_line) - len(first_line.lstrip())
@@ -25,15 +36,56 @@ def iter_dedent(lines):
             break
 
 
-def get_def_source(fn):
+def parse_file(filename):
+    try:
+        return parse_file.cache[filename]
+    except KeyError:
+        source = ''.join(lines_from(filename, 1))
+        module = parse_file.cache[filename] = ast.parse(source, filename)
+        return module
+
+parse_file.cache = {}
+
+
+def def_line(filename, node):
+    # Line of the def statement of the FunctionDef node.
+    # Before Python 3.8, node.lineno is that of the first decorator.
+    if not node.decorator_list or node.lineno > node.decorator_list[-1].lineno:
+        return node.lineno
+    line = node.decorator_list[-1].lineno
+    for i, text in enumerate(lines_from(filename, line)):
+        if text.lstrip().startswith(('def ', 'async def ')):
+            return line + i
+
+
+def get_def_lineno(fn):
+    # co_firstlineno of a decorated function is that of its first decorator
     code = fn.__code__
-    lines = lines_from(code.co_filename, code.co_firstlineno)
+    for node in ast.walk(parse_file(code.co_filename)):
+        if (isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and
+                node.name == code.co_name and
+                min([node.lineno] + [d.lineno for d in node.decorator_list])
+                == code.co_firstlineno):
+            return def_line(code.co_filename, node)
+    return code.co_firstlineno
+
+
+def get_source_at(filename, line):
+    lines = lines_from(filename, line)
     lines = iter_dedent(lines)
     lines = list(lines)
     source = ''.join(lines)
     return source
 
 
+def get_def_source(fn):
+    return get_source_at(fn.__code__.co_filename, get_def_lineno(fn))
+
+
+def source_hash(source):
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
 def get_def_ast(fn):
     source = get_def_source(fn)
     assert source.startswith('def ')
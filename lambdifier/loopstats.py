@@ -0,0 +1,47 @@
+import time
+
+
+class LoopStats:
+    def __init__(self):
+        # Number of times the loop was entered
+        self.runs = 0
+        self.iterations = 0
+        # Wall time from entering the loop until its iterable is exhausted
+        self.time = 0.0
+
+    def as_dict(self):
+        return {'runs': self.runs, 'iterations': self.iterations,
+                'time': self.time}
+
+    def __repr__(self):
+        return 'LoopStats(runs=%d, iterations=%d, time=%.6f)' % (
+            self.runs, self.iterations, self.time)
+
+
+# (filename, lineno, col_offset) of the for statement -> LoopStats
+registry = {}
+
+
+def count(key, iterable):
+    try:
+        stats = registry[key]
+    except KeyError:
+        stats = registry[key] = LoopStats()
+    stats.runs += 1
+    n = 0
+    t = time.perf_counter()
+    try:
+        for x in iterable:
+            n += 1
+            yield x
+    finally:
+        stats.iterations += n
+        stats.time += time.perf_counter() - t
+
+
+def report():
+    return {key: stats.as_dict() for key, stats in registry.items()}
+
+
+def reset():
+    registry.clear()
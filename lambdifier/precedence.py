@@ -1,5 +1,4 @@
 import ast
-import contextlib
 
 
 PRECEDENCE = [
@@ -24,28 +23,57 @@ PRECEDENCE = [
 ]
 
 
+PRECEDENCE_TABLE = {op: i for i, ops in enumerate(PRECEDENCE) for op in ops}
+
+
 def precedence(op):
-    for i in range(len(PRECEDENCE)):
-        if op in PRECEDENCE[i]:
-            return i
+    return PRECEDENCE_TABLE.get(op)
 
 
 class AutoParens:
     def __init__(self):
         self.precedence = [-1]
+        # Side of the enclosing operator the current operand is on
+        self.sides = [None]
         self.p_level = 0
 
-    @contextlib.contextmanager
-    def __call__(self, node, op, left, right):
+    def operand(self, side):
+        # side is 'left', 'right' or None for the operand of a unary operator
+        self.sides[-1] = side
+
+    def open(self, op):
         # From fstrings
-        prec = precedence(type(op))
-        if self.precedence[-1] > prec:
-            self.precedence.append(-1)
+        prec = PRECEDENCE_TABLE[type(op)]
+        parent, side = self.precedence[-1], self.sides[-1]
+        if parent == prec:
+            # Keep a - (b - c), (a ** b) ** c, (a < b) < c and
+            # (a and b) and c, which would parse as a single BoolOp
+            if prec == PRECEDENCE_TABLE[ast.Pow]:
+                parens = side == 'left'
+            elif prec in (PRECEDENCE_TABLE[ast.Lt], PRECEDENCE_TABLE[ast.And],
+                          PRECEDENCE_TABLE[ast.Or]):
+                parens = side is not None
+            else:
+                parens = side == 'right'
+        else:
+            parens = parent > prec
+        self.precedence.append(prec)
+        self.sides.append(None)
+        if parens:
             self.p_level += 1
-            yield '(', ')'
-            self.p_level -= 1
-            self.precedence.pop()
+            return '(', ')'
         else:
-            self.precedence.append(prec)
-            yield '', ''
-            self.precedence.pop()
+            return '', ''
+
+    def bracket(self):
+        # Call arguments, subscripts and elements of displays need no
+        # parentheses; end with close('')
+        self.precedence.append(-1)
+        self.sides.append(None)
+
+    def close(self, r):
+        # r is the closing parenthesis returned by open()
+        if r:
+            self.p_level -= 1
+        self.precedence.pop()
+        self.sides.pop()
@@ -0,0 +1,60 @@
+import ast
+import time
+import contextlib
+import functools
+
+
+class TranslationProfile:
+    '''Time and call counts of a single Lambdifier translation.
+
+    Phase times are exclusive of each other; method times are inclusive,
+    i.e. the time of visit_For contains the time of visiting its body.
+    '''
+
+    def __init__(self):
+        self.phases = {}
+        self.calls = {}
+        self.times = {}
+        self.nodes = 0
+        self.output_size = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        yield
+        self.phases[name] = (self.phases.get(name, 0) +
+                             time.perf_counter() - t)
+
+    def wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            t = time.perf_counter()
+            yield from method(*args)
+            self.times[name] = (self.times.get(name, 0) +
+                                time.perf_counter() - t)
+
+        return wrapper
+
+    def count_nodes(self, node):
+        self.nodes = sum(1 for _ in ast.walk(node))
+
+    def report(self):
+        return {
+            'phases': dict(self.phases),
+            'methods': {name: {'calls': n, 'time': self.times.get(name, 0)}
+                        for name, n in self.calls.items()},
+            'nodes': self.nodes,
+            'output_size': self.output_size,
+        }
+
+    def __str__(self):
+        lines = ['%-24s %10.6f' % (name, t)
+                 for name, t in self.phases.items()]
+        lines.append('%d nodes, %d characters output' %
+                     (self.nodes, self.output_size))
+        methods = sorted(self.calls, key=lambda k: -self.times.get(k, 0))
+        lines.extend('%-24s %6d %10.6f' % (name, self.calls[name],
+                                           self.times.get(name, 0))
+                     for name in methods)
+        return '\n'.join(lines)
@@ -0,0 +1,108 @@
+import bisect
+import pstats
+import linecache
+import traceback
+
+
+class SourceMap:
+    '''Map positions in generated lambda text back to the original source.
+
+    Line numbers are lines of `filename` (or of the translated string,
+    if the function was given as source), column offsets are relative to
+    the dedented function definition.
+    '''
+
+    def __init__(self, name='<lambda>', filename=None, first_lineno=1):
+        self.name = name
+        self.filename = filename
+        self.first_lineno = first_lineno
+        self.generated_filename = '<lambdified %s>' % name
+        self.source = ''
+        # Output offsets at which the current source location changes
+        self.offsets = []
+        self.locations = []
+        self.lines = []
+
+    def record(self, chunks, location):
+        # `location` is the Lambdifier's stack of located AST nodes,
+        # whose top is the node that emitted the current chunk.
+        parts = []
+        offset = 0
+        for chunk in chunks:
+            if location:
+                node = location[-1]
+                loc = (node.lineno + self.first_lineno - 1, node.col_offset)
+                if not self.locations or self.locations[-1] != loc:
+                    self.offsets.append(offset)
+                    self.locations.append(loc)
+            parts.append(chunk)
+            offset += len(chunk)
+        self.source = ''.join(parts)
+        self.lines = self.line_map()
+        return self.source
+
+    def location(self, offset):
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i < 0:
+            return (self.first_lineno, 0)
+        return self.locations[i]
+
+    def line_map(self):
+        # Original line of each generated line (index 0 is line 1)
+        starts = [0]
+        i = self.source.find('\n')
+        while i != -1:
+            starts.append(i + 1)
+            i = self.source.find('\n', i + 1)
+        return [self.location(s)[0] for s in starts]
+
+    def original_line(self, line):
+        if 1 <= line <= len(self.lines):
+            return self.lines[line - 1]
+        return self.first_lineno
+
+    def compile(self):
+        # Register the generated text so tracebacks can show it
+        lines = self.source.splitlines(True)
+        linecache.cache[self.generated_filename] = (
+            len(self.source), None, lines, self.generated_filename)
+        return compile(self.source, self.generated_filename, 'eval')
+
+    def original_filename(self):
+        return self.filename or '<string>'
+
+    def translate_traceback(self, tb):
+        frames = []
+        for frame in traceback.extract_tb(tb):
+            if frame.filename == self.generated_filename:
+                lineno = self.original_line(frame.lineno)
+                filename = self.original_filename()
+                frame = traceback.FrameSummary(
+                    filename, lineno, frame.name,
+                    line=linecache.getline(filename, lineno).strip())
+            frames.append(frame)
+        return traceback.StackSummary.from_list(frames)
+
+    def translate_key(self, key):
+        filename, lineno, name = key
+        if filename != self.generated_filename:
+            return key
+        return (self.original_filename(), self.original_line(lineno), name)
+
+    def translate_stats(self, stats):
+        # Rewrite the keys of a pstats.Stats in place, merging entries
+        # that map to the same original line.
+        result = {}
+        for key, (cc, nc, tt, ct, old_callers) in stats.stats.items():
+            callers = {}
+            for k, v in old_callers.items():
+                callers = pstats.add_callers(
+                    callers, {self.translate_key(k): v})
+            key = self.translate_key(key)
+            if key in result:
+                result[key] = pstats.add_func_stats(
+                    result[key], (cc, nc, tt, ct, callers))
+            else:
+                result[key] = (cc, nc, tt, ct, callers)
+        stats.stats = result
+        return stats
@@ -1,8 +1,25 @@
+import os
+import ast
+import io
+import contextlib
+import concurrent.futures
+import functools
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from lambdifier import (
     get_def_source, get_def_ast, get_local_vars, LocalVars,
 )
-from lambdifier.lambdify import Lambdifier, foldl
+from lambdifier import (
+    client, daemon, fuzz, loopstats, lazy, watch, lambdified,
+)
+from lambdifier.lambdify import Lambdifier, foldl, lambdify
+from lambdifier.budget import Budget, BudgetExceeded
+from lambdifier.precedence import AutoParens
 
 
 class TestLines(unittest.TestCase):
@@ -12,6 +29,15 @@ class TestLines(unittest.TestCase):
 
         self.assertEqual(get_def_source(f), 'def f():\n    return 42\n')
 
+    def test_decorator(self):
+        @functools.partial(
+            lambda tag, fn: fn,
+            'tag')
+        def f():
+            return 42
+
+        self.assertEqual(get_def_source(f), 'def f():\n    return 42\n')
+
 
 class TestLocalVars(unittest.TestCase):
     def test_simple(self):
@@ -176,6 +202,562 @@ class LambdifierTest(unittest.TestCase):
         l = eval(source)
         self.assertEqual(l(), f())
 
+    def test_store(self):
+        def f(xs, o):
+            xs[0] = 1
+            o.a = 2
+            xs[1], o.b = 3, 4
+            xs[2] = o.c = 5
+
+        source = Lambdifier()(f)
+        self.assertIn('(xs).__setitem__(0, 1)', source)
+        self.assertIn("setattr(o, 'a', 2)", source)
+        self.assertIn('(xs).__setitem__(1, _t0)', source)
+        self.assertIn("setattr(o, 'b', _t1)", source)
+        self.assertIn('(xs).__setitem__(2, _t)', source)
+        l = eval(source)
+
+        class O:
+            pass
+
+        xs, o = [0, 0, 0], O()
+        l(xs, o)
+        self.assertEqual(xs, [1, 3, 5])
+        self.assertEqual(vars(o), {'a': 2, 'b': 4, 'c': 5})
+
+    def test_store_order(self):
+        # The value is evaluated before the target
+        def f(xs):
+            xs[len(xs) - 1] = xs.pop()
+            xs[0] = xs[1]
+            return xs
+
+        source = Lambdifier()(f)
+        self.assertIn('(xs).__setitem__(len(xs) - 1, _t0)', source)
+        self.assertIn('(xs).__setitem__(0, xs[1])', source)
+        self.assertEqual(eval(source)([1, 2, 3]), [3, 3])
+
+        def f(d, k):
+            d[k][0] = d.setdefault(k, [0, 0]) and 7
+            return d
+
+        source = Lambdifier()(f)
+        self.assertEqual(eval(source)({}, 1), f({}, 1))
+
+        def f(xs):
+            xs[0][0] = xs.pop(0)
+            return xs
+
+        source = Lambdifier()(f)
+        self.assertEqual(eval(source)([[1], [2]]), [[[1]]])
+
+    def test_batch(self):
+        source = Lambdifier(batch=True)(kmeans)
+        self.assertTrue(source.startswith('lambda _batch: (_result'))
+        l = eval(source)
+        args = [([1, 2, 6, 7], 2), ([1, 2, 6, 7, 21], 3)]
+        results = l(iter(args))
+        self.assertEqual(next(results), kmeans(*args[0]))
+        self.assertEqual(next(results), kmeans(*args[1]))
+        self.assertEqual(list(results), [])
+
+        def f(a, b=10):
+            return a + b
+
+        with self.assertRaises(NotImplementedError):
+            Lambdifier(batch=True)(f)
+
+        def f():
+            return 42
+
+        self.assertEqual(list(eval(Lambdifier(batch=True)(f))([(), ()])),
+                         [42, 42])
+
+    def test_operators(self):
+        def f(a, b, xs):
+            return (not (a and b), (a < b) + 1, -a ** 2, (-a) ** 2,
+                    a not in xs, ~a | b, not a < b, a << 2 & b,
+                    a - (b - 1), a * (b % 3), (a ** 2) ** b, (a < b) < 1)
+
+        source = Lambdifier()(f)
+        self.assertIn('a not in xs', source)
+        self.assertIn('a - (b - 1)', source)
+        self.assertIn('a * (b % 3)', source)
+        self.assertIn('(a ** 2) ** b', source)
+        self.assertIn('(a < b) < 1', source)
+        l = eval(source)
+        for args in [(0, 1, []), (2, 3, [2]), (-1, -1, [0])]:
+            self.assertEqual(l(*args), f(*args))
+
+        def f(a, b, c):
+            return (-((a or b) + c), ((a and b) > 2) != c,
+                    (a | (not b)) & c)
+
+        source = Lambdifier()(f)
+        self.assertIn('-((a or b) + c)', source)
+        self.assertIn('((a and b) > 2) != c', source)
+        self.assertIn('(a | (not b)) & c', source)
+        l = eval(source)
+        for args in [(0, 1, 2), (3, 0, 1), (1, 1, 0)]:
+            self.assertEqual(l(*args), f(*args))
+
+    def test_parens(self):
+        # Emitting parsed random expressions gives back the same AST
+        rng = random.Random(0)
+        binops = ['+', '-', '*', '/', '//', '%', '**', '<<', '>>', '&', '|',
+                  '^', 'and', 'or', '<', '<=', '==', '!=', 'in', 'is not']
+
+        def expr(depth):
+            if depth == 0:
+                return rng.choice('abc')
+            e = lambda: expr(depth - 1)
+            kind = rng.randrange(7)
+            if kind < 3:
+                return '(%s) %s (%s)' % (e(), rng.choice(binops), e())
+            elif kind == 3:
+                return '%s(%s)' % (rng.choice(['not ', '-', '+', '~']), e())
+            elif kind == 4:
+                return '(%s) < (%s) <= (%s)' % (e(), e(), e())
+            elif kind == 5:
+                form = rng.choice(['(%s).real', '(%s)[%s]', 'f(%s, %s)',
+                                   '(%s)(%s)', '(%s, %s)', '[%s]'])
+                return form % tuple(e() for _ in range(form.count('%s')))
+            return '(%s) ** (%s)' % (e(), e())
+
+        for _ in range(500):
+            node = ast.parse(expr(rng.randrange(1, 5)), mode='eval').body
+            l = Lambdifier()
+            l.auto_parens = AutoParens()
+            source = ''.join(l.visit(node))
+            self.assertEqual(
+                ast.dump(ast.parse(source, mode='eval').body),
+                ast.dump(node), source)
+
+
+class ProfileTest(unittest.TestCase):
+    def test_profile(self):
+        def f(a):
+            for i in range(a):
+                a = a + i
+            return a
+
+        reports = []
+        l = Lambdifier(profile=reports.append)
+        source = l(f)
+        self.assertEqual(source, Lambdifier()(f))
+        p, = reports
+        self.assertIs(p, l.profile)
+        report = p.report()
+        self.assertEqual(set(report['phases']),
+                         {'source', 'ReadBeforeWrite', 'LocalVars',
+                          'ReadVars', 'emit'})
+        self.assertEqual(report['methods']['visit_For']['calls'], 1)
+        self.assertEqual(report['methods']['target_Name']['calls'], 1)
+        self.assertEqual(report['output_size'], len(source))
+        self.assertGreater(report['nodes'], 0)
+        self.assertNotIn('visit_For', vars(l))
+
+    def test_lambdify(self):
+        reports = []
+        lambdify('def f():\n    return 42\n', profile=reports.append)
+        self.assertEqual(len(reports), 1)
+        with self.assertRaises(TypeError):
+            lambdify('def f():\n    return 42\n', profile=True)
+        self.assertEqual(lambdify('def f():\n    return 42\n', profile=False),
+                         lambdify('def f():\n    return 42\n'))
+
+    def test_disabled(self):
+        l = Lambdifier()
+        l('def f():\n    return 42\n')
+        self.assertIsNone(l.profile)
+
+
+class SourceMapTest(unittest.TestCase):
+    def test_lines(self):
+        def f(a):
+            x = 0
+            for i in range(a):
+                x = x + i
+            y = 1 / (x - 3)
+            return y
+
+        l = Lambdifier(source_map=True)
+        source = l(f)
+        self.assertEqual(source, Lambdifier()(f))
+        m = l.source_map
+        first = f.__code__.co_firstlineno
+        generated = source.split('\n')
+        self.assertEqual(len(m.lines), len(generated))
+        self.assertEqual(m.lines[0], first)
+        line = [i for i, s in enumerate(generated) if '1 / ' in s][0]
+        self.assertEqual(m.original_line(line + 1), first + 4)
+
+    def test_traceback(self):
+        def f(a):
+            x = a - 1
+            return 1 / x
+
+        l = Lambdifier(source_map=True)
+        l(f)
+        g = eval(l.source_map.compile())
+        try:
+            g(1)
+        except ZeroDivisionError as e:
+            frame = l.source_map.translate_traceback(e.__traceback__)[-1]
+        self.assertEqual(frame.filename, f.__code__.co_filename)
+        self.assertEqual(frame.lineno, f.__code__.co_firstlineno + 2)
+        self.assertEqual(frame.line, 'return 1 / x')
+
+
+class LoopStatsTest(unittest.TestCase):
+    def test_count(self):
+        def f(n):
+            s = 0
+            for i in range(n):
+                s = s + i
+                for j in range(i):
+                    t = j
+            return s
+
+        self.assertEqual(Lambdifier()(f), Lambdifier(count_loops=False)(f))
+        l = eval(Lambdifier(count_loops=True)(f))
+        loopstats.reset()
+        self.assertEqual(l(4), f(4))
+        self.assertEqual(l(3), f(3))
+        first = f.__code__.co_firstlineno
+        outer = loopstats.registry[(__file__, first + 2, 4)]
+        inner = loopstats.registry[(__file__, first + 4, 8)]
+        self.assertEqual((outer.runs, outer.iterations), (2, 7))
+        self.assertEqual((inner.runs, inner.iterations), (7, 9))
+
+
+class BudgetTest(unittest.TestCase):
+    def test_metrics(self):
+        l = Lambdifier()
+        source = l(kmeans)
+        m = l.metrics
+        self.assertEqual(m.size, len(source))
+        self.assertEqual(m.folds, 6)
+        self.assertEqual(m.depth, 6)
+        self.assertEqual(m.width, 4)
+
+    def test_exceeded(self):
+        with self.assertRaises(BudgetExceeded) as cm:
+            Lambdifier(budget=Budget(depth=5))(kmeans)
+        self.assertEqual(cm.exception.name, 'depth')
+        self.assertEqual(cm.exception.metrics.depth, 6)
+        with self.assertRaises(BudgetExceeded) as cm:
+            Lambdifier(budget=Budget(size=1000))(kmeans)
+        self.assertLess(cm.exception.metrics.size, 1200)
+        Lambdifier(budget=Budget(depth=6, width=4))(kmeans)
+
+
+class LambdifiedTest(unittest.TestCase):
+    def test_lazy(self):
+        calls = []
+        lambdifier = lazy.Lambdifier
+
+        class Counting(lambdifier):
+            def __call__(self, node):
+                calls.append(node)
+                return super().__call__(node)
+
+        lazy.Lambdifier = Counting
+        try:
+            f = lambdified(fib)
+            self.assertEqual(calls, [])
+            self.assertEqual(f.__name__, 'fib')
+            self.assertEqual([f(n) for n in range(7)],
+                             [0, 1, 1, 2, 3, 5, 8])
+            self.assertEqual(len(calls), 1)
+        finally:
+            lazy.Lambdifier = lambdifier
+
+    def test_fallback(self):
+        def f(xs):
+            for a, b in xs:
+                pass
+            return len(xs)
+
+        g = lambdified(f)
+        with self.assertLogs('lambdifier.lazy') as log:
+            self.assertEqual(g([(1, 2)]), 1)
+        self.assertIn('for-variable not a single name', log.output[0])
+
+        def f(a):
+            if a:
+                return 1
+            return 2
+
+        g = lambdified(f)
+        with self.assertLogs('lambdifier.lazy') as log:
+            self.assertEqual([g(True), g(False)], [1, 2])
+        self.assertIn('return not at end of function', log.output[0])
+
+        def f(a):
+            try:
+                b = a
+            finally:
+                b = 0
+            return b
+
+        g = lambdified(f)
+        with self.assertLogs('lambdifier.lazy'), \
+                contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertEqual(g(1), 0)
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_decorated(self):
+        self.assertEqual([fib2(n) for n in range(7)], [0, 1, 1, 2, 3, 5, 8])
+        self.assertIsNot(fib2.impl, fib2.__wrapped__)
+
+    def test_pickle(self):
+        data = pickle.dumps(fib2)
+        self.assertIs(pickle.loads(data), fib2)
+        # A fresh process looks the function up by name
+        key = (__name__, 'fib2', fib2.source_hash)
+        del lazy.cache[key]
+        self.assertIs(pickle.loads(data), fib2)
+        self.assertIs(lazy.cache[key], fib2)
+        # Same source, different function
+        self.assertIs(pickle.loads(pickle.dumps(K1.k)), K1.k)
+        self.assertIs(pickle.loads(pickle.dumps(K2.k)), K2.k)
+        with self.assertRaises(pickle.UnpicklingError):
+            lazy.rebuild(__name__, 'fib2', 'x')
+        with self.assertRaises(pickle.PicklingError):
+            pickle.dumps(lambdified(lambda: 0))
+
+    def test_batch(self):
+        self.assertEqual(list(fib2.batch([(n,) for n in range(7)])),
+                         [0, 1, 1, 2, 3, 5, 8])
+
+        def f(*xs):
+            return len(xs)
+
+        self.assertEqual(list(lambdified(f).batch([(), (1, 2)])), [0, 2])
+
+        def f(a, b=10):
+            return a + b
+
+        self.assertEqual(list(lambdified(f).batch([(1,), (1, 2)])), [11, 3])
+
+        def f():
+            return 42
+
+        self.assertEqual(list(lambdified(f).batch([(), ()])), [42, 42])
+
+    def test_pool(self):
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            self.assertEqual(list(pool.map(fib2, range(7))),
+                             [0, 1, 1, 2, 3, 5, 8])
+
+
+class FuzzTest(unittest.TestCase):
+    source = (
+        'def f(a, b, xs, o):\n'
+        '    x = 0\n'
+        '    for i in range(len(xs)):\n'
+        '        x = x + xs[i]\n'
+        '    o.p = x\n'
+        '    xs[a % len(xs)] = b\n'
+        '    return x\n')
+
+    def test_generator(self):
+        gen = fuzz.FunctionGenerator(random.Random(1))
+        for _ in range(20):
+            compile(gen.function(), '<fuzz>', 'exec')
+        a, b, xs, o = gen.arguments()
+        self.assertTrue(xs)
+
+    def test_check(self):
+        gen = fuzz.FunctionGenerator(random.Random(1))
+        args_list = [gen.arguments() for _ in range(3)]
+        result = fuzz.check(self.source, args_list, number=2)
+        self.assertTrue(result.ok, str(result))
+        self.assertGreater(result.ratio, 0)
+
+    def test_mismatch(self):
+        gen = fuzz.FunctionGenerator(random.Random(1))
+        args_list = [gen.arguments() for _ in range(3)]
+        result = fuzz.check(self.source, args_list,
+                            translate=lambda s: 'lambda a, b, xs, o: 0')
+        self.assertFalse(result.ok)
+        args, expected, actual = result.mismatch
+        self.assertEqual(actual[0], 0)
+        self.assertTrue(result.failure().startswith('mismatch on '))
+
+    def test_baseline(self):
+        # Every function returning 0 is a mismatch
+        zero = lambda s: 'lambda a, b, xs, o: 0'
+        options = dict(count=3, seed=0, inputs=2, number=1)
+        flagged = list(fuzz.fuzz(translate=zero, **options))
+        self.assertEqual([r.name for r in flagged], ['0:0', '0:1', '0:2'])
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'baseline.json')
+            fuzz.save_baseline(filename,
+                               fuzz.results(translate=zero, **options))
+            baseline = fuzz.load_baseline(filename)
+        self.assertEqual(sorted(baseline), sorted(r.hash for r in flagged))
+        self.assertEqual(
+            list(fuzz.fuzz(baseline=baseline, translate=zero, **options)), [])
+        # A known mismatch that changes is flagged again
+        one = lambda s: 'lambda a, b, xs, o: 1'
+        self.assertEqual(
+            [r.name for r in fuzz.fuzz(baseline=baseline, translate=one,
+                                       **options)],
+            ['0:0', '0:1', '0:2'])
+        # So is a known failure that becomes slow
+        self.assertEqual(
+            len(list(fuzz.fuzz(baseline=baseline, translate=zero,
+                               max_ratio=0, **options))), 3)
+
+
+class WatchTest(unittest.TestCase):
+    def write(self, filename, source, mtime):
+        with open(filename, 'w') as fp:
+            fp.write(source)
+        os.utime(filename, ns=(mtime, mtime))
+
+    def test_poll(self):
+        f = 'def f(a):\n    return a + {}\n'
+        g = ('class C:\n    def g(self):\n'
+             '        for x, y in []:\n            pass\n')
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'm.py')
+            self.write(filename, f.format(1) + '\n\n' + g, 10 ** 9)
+            w = watch.Watcher([d])
+            changed = w.poll()
+            self.assertEqual([t.qualname for t in changed], ['f', 'C.g'])
+            self.assertIn('a + 1', changed[0].result)
+            self.assertIsInstance(changed[1].error, NotImplementedError)
+            self.assertEqual(w.poll(), [])
+
+            self.write(filename, f.format(2) + '\n\n' + g, 2 * 10 ** 9)
+            changed = w.poll()
+            self.assertEqual([t.qualname for t in changed], ['f'])
+            self.assertIn('a + 2', changed[0].result)
+            self.assertEqual(w.translations[filename]['C.g'].lineno, 6)
+
+            os.remove(filename)
+            self.assertEqual(w.poll(), [])
+            self.assertEqual(w.translations, {})
+
+    def test_error(self):
+        source = ('def f(a):\n    try:\n        pass\n'
+                  '    finally:\n        pass\n\n\n'
+                  'def g(_):\n    return 1\n\n\n'
+                  'def h(a):\n    return a\n')
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'm.py')
+            self.write(filename, source, 10 ** 9)
+            changed = watch.Watcher([d]).poll()
+            self.assertEqual([t.qualname for t in changed], ['f', 'g', 'h'])
+            self.assertIsInstance(changed[0].error, NotImplementedError)
+            self.assertIsInstance(changed[1].error, AssertionError)
+            self.assertIn('lambda a: ', changed[2].result)
+
+
+class DaemonTest(unittest.TestCase):
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'lambdifier.sock')
+            self.assertEqual(client.lambdify(fib, path=path),
+                             Lambdifier()(fib))
+            server = daemon.Server(path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with self.assertRaises(OSError):
+                    daemon.Server(path)
+                for _ in range(2):
+                    self.assertEqual(client.lambdify(fib, path=path),
+                                     Lambdifier()(fib))
+                self.assertEqual(server.hits, 1)
+                self.assertEqual(
+                    client.lambdify(fib, batch=True, path=path),
+                    Lambdifier(batch=True)(fib))
+                with self.assertRaises(NotImplementedError):
+                    client.lambdify('def f():\n    while 1:\n        pass\n',
+                                    path=path)
+                # The server hashes the source itself
+                responses = [server.translate({'hash': 'x', 'source': s})
+                             for s in ('def f():\n    return 1\n',
+                                       'def f():\n    return 2\n')]
+                self.assertNotEqual(responses[0], responses[1])
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+            self.assertFalse(os.path.exists(path))
+
+    def test_permissions(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'lambdifier.sock')
+            server = daemon.Server(path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                client.Client(path).close()
+                # Another user could have replaced the socket
+                os.chmod(d, 0o777)
+                with self.assertRaises(PermissionError):
+                    client.Client(path)
+                self.assertEqual(client.lambdify(fib, path=path),
+                                 Lambdifier()(fib))
+                self.assertEqual(server.cache, {})
+            finally:
+                os.chmod(d, 0o700)
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_client_imports(self):
+        # The client does not load the translator unless it falls back
+        code = ('import sys, lambdifier.client; '
+                'print(sorted(m for m in sys.modules if "lambdifier" in m))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(out.decode().strip(),
+                         "['lambdifier', 'lambdifier.client']")
+
+    def test_default_path(self):
+        environ = dict(os.environ)
+        try:
+            os.environ.pop('LAMBDIFIER_SOCKET', None)
+            os.environ['XDG_RUNTIME_DIR'] = '/run/user/1000'
+            self.assertEqual(client.default_path(),
+                             '/run/user/1000/lambdifier.sock')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+def fib(n):
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+
+
+@lambdified
+def fib2(n):
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+
+
+class K1:
+    @lambdified
+    def k(x):
+        return x + 1
+
+
+class K2:
+    @lambdified
+    def k(x):
+        return x + 1
+
 
 def kmeans(x, K):
     r'''
@@ -0,0 +1,146 @@
+'''Retranslate functions of edited source files.
+
+Usage: python -m lambdifier.watch [--interval SECONDS] PATH...
+
+The Watcher keeps each file's parsed module and the translation of each
+function in memory. When a file changes, only functions whose source
+hash differs from the previous poll are lambdified again.
+'''
+import os
+import ast
+import time
+import logging
+import argparse
+from lambdifier.lines import (
+    invalidate, parse_file, def_line, get_source_at, source_hash)
+from lambdifier.lambdify import lambdify
+
+
+logger = logging.getLogger(__name__)
+
+
+class Translation:
+    def __init__(self, filename, qualname, lineno, source):
+        self.filename = filename
+        self.qualname = qualname
+        self.lineno = lineno
+        self.source = source
+        self.hash = source_hash(source)
+        self.result = None
+        # Exception raised by the translation, if any
+        self.error = None
+
+    def __str__(self):
+        where = '%s:%d: %s' % (self.filename, self.lineno, self.qualname)
+        if self.error is not None:
+            return '%s: %s: %s' % (where, type(self.error).__name__,
+                                   self.error)
+        return '%s\n%s' % (where, self.result)
+
+
+def find_functions(module):
+    # Top-level functions and methods of top-level classes
+    for node in module.body:
+        if isinstance(node, ast.FunctionDef):
+            yield node.name, node
+        elif isinstance(node, ast.ClassDef):
+            for child in node.body:
+                if isinstance(child, ast.FunctionDef):
+                    yield '%s.%s' % (node.name, child.name), child
+
+
+class Watcher:
+    def __init__(self, paths, translate=lambdify):
+        self.paths = list(paths)
+        self.translate = translate
+        # filename -> (mtime, size) when last parsed
+        self.stamps = {}
+        # filename -> ast.Module
+        self.modules = {}
+        # filename -> {qualname: Translation}
+        self.translations = {}
+
+    def files(self):
+        for path in self.paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith('.py'):
+                        yield os.path.join(dirpath, filename)
+
+    def poll(self):
+        '''Update changed files; return the Translations that were redone.'''
+        changed = []
+        seen = set()
+        for filename in self.files():
+            seen.add(filename)
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            if self.stamps.get(filename) == stamp:
+                continue
+            self.stamps[filename] = stamp
+            try:
+                changed.extend(self.update(filename))
+            except SyntaxError as e:
+                # Keep the previous translations until the file parses
+                logger.warning('%s: %s', filename, e)
+        for filename in set(self.stamps) - seen:
+            self.forget(filename)
+        return changed
+
+    def update(self, filename):
+        invalidate(filename)
+        module = parse_file(filename)
+        self.modules[filename] = module
+        old = self.translations.get(filename, {})
+        new = self.translations[filename] = {}
+        for qualname, node in find_functions(module):
+            lineno = def_line(filename, node)
+            source = get_source_at(filename, lineno).rstrip() + '\n'
+            t = old.get(qualname)
+            if t is not None and t.hash == source_hash(source):
+                t.lineno = lineno
+                new[qualname] = t
+                continue
+            t = new[qualname] = Translation(
+                filename, qualname, lineno, source)
+            try:
+                t.result = self.translate(source)
+            except Exception as e:
+                # Keep going; the other functions are independent
+                t.error = e
+            yield t
+
+    def forget(self, filename):
+        invalidate(filename)
+        del self.stamps[filename]
+        self.modules.pop(filename, None)
+        self.translations.pop(filename, None)
+
+    def watch(self, interval=0.5, callback=print):
+        # Poll forever, passing each new Translation to callback
+        while True:
+            for t in self.poll():
+                callback(t)
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    try:
+        Watcher(args.paths).watch(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()